@@ -1,58 +1,247 @@
 import os
 import re
-import json
-from typing import Any, Dict
+import asyncio
+import functools
+import hashlib
+import math
+import time
+import atexit
+import logging
+import queue
+from contextlib import aclosing, asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
+from typing import Annotated, Any, AsyncIterator, Dict, List, Optional, Type, TypeVar
+import httpx
+import orjson
 import uvicorn
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from starlette.responses import JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from pydantic import BaseModel, Field, ValidationError
+from cachetools import TTLCache
+import redis.asyncio as aioredis
+from json_repair import repair_json
+from starlette.responses import JSONResponse, Response, StreamingResponse
 
 # New Gemini SDK
 from google import genai
-from google.genai import types
-from fastapi import FastAPI, HTTPException, Header
-from starlette.responses import JSONResponse
+from google.genai import errors, types
 
-from dotenv import load_dotenv
-load_dotenv()
+# Production (Render) sets the environment directly; .env is for local dev.
+if os.getenv("ENV") != "production":
+    from dotenv import load_dotenv
+    load_dotenv()
 
 # ---------------------------
 # Config
 # ---------------------------
 MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
 
+# Bump whenever SYSTEM_INSTRUCTION changes so responses produced by an older
+# prompt are never served from the cache.
+PROMPT_VERSION = "v3"
+
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "1024"))
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", "3600"))
+
+# Optional shared cache tier so all workers/instances see each other's
+# results; unset keeps the cache purely in-process.
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_CACHE_TTL_SECONDS = int(os.getenv("REDIS_CACHE_TTL_SECONDS", "86400"))
+
+# Upper bound on resumeText; longer payloads are rejected before any prompt
+# work or Gemini call happens.
+MAX_RESUME_CHARS = int(os.getenv("MAX_RESUME_CHARS", "100000"))
+
+# Raw request body cap, checked before the body is buffered or parsed.
+MAX_BODY_BYTES = int(os.getenv("MAX_BODY_BYTES", str(2 * 1024 * 1024)))
+
+# Most resumes accepted in one batch request; larger batches are rejected
+# with 422 so a single request can't queue up the whole worker's Gemini slots.
+MAX_BATCH_ITEMS = int(os.getenv("MAX_BATCH_ITEMS", "50"))
+
+# Max Gemini calls each worker keeps in flight at once, across all requests;
+# excess calls wait instead of running into the provider's rate limit.
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "32"))
+
+# Resumes each org-id may submit per minute (per worker) before getting 429s,
+# so one org can't use up the shared Gemini quota; a batch counts every resume
+# in it. 0 disables it.
+ORG_RATE_LIMIT_PER_MINUTE = int(os.getenv("ORG_RATE_LIMIT_PER_MINUTE", "60"))
+
+# Timeout for each Gemini HTTP attempt (retries get their own).
+GEMINI_TIMEOUT_MS = int(os.getenv("GEMINI_TIMEOUT_MS", "60000"))
+
+# Total attempts per Gemini request (first try included) on transient errors.
+GEMINI_RETRY_ATTEMPTS = int(os.getenv("GEMINI_RETRY_ATTEMPTS", "4"))
+
+# Hard ceiling for the per-request output budget (see _max_output_tokens).
+GEMINI_MAX_OUTPUT_TOKENS = int(os.getenv("GEMINI_MAX_OUTPUT_TOKENS", "32768"))
+
+# Lifetime of the Gemini-side cached copy of the static instructions.
+PROMPT_CACHE_TTL_SECONDS = int(os.getenv("PROMPT_CACHE_TTL_SECONDS", "3600"))
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# Comma-separated list of browser origins allowed to call the API.
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "*").split(",") if o.strip()]
+
+# Local dev server (Render passes these on the uvicorn command line / env).
+PORT = int(os.getenv("PORT", "8000"))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "4"))
+
 if not os.getenv("GEMINI_API_KEY"):
     # The new client reads GEMINI_API_KEY from the env automatically;
     # we check early to fail fast on Render if it's missing.
     raise RuntimeError("GEMINI_API_KEY environment variable is not set")
 
-client = genai.Client()  # picks up GEMINI_API_KEY from environment
+# Picks up GEMINI_API_KEY from the environment.
+client = genai.Client(
+    http_options=types.HttpOptions(
+        timeout=GEMINI_TIMEOUT_MS,
+        # One shared keep-alive pool, multiplexed over HTTP/2, so concurrent
+        # requests reuse TLS connections instead of queueing on the default
+        # pool or paying a fresh handshake.
+        async_client_args={
+            "http2": True,
+            "limits": httpx.Limits(max_connections=200, max_keepalive_connections=100),
+        },
+        # Transient 408/429/5xx responses and connection errors are retried
+        # with jittered exponential backoff, capped at a few seconds so a
+        # retried request still answers well inside the client's patience.
+        retry_options=types.HttpRetryOptions(
+            attempts=GEMINI_RETRY_ATTEMPTS, initial_delay=0.2, max_delay=5.0
+        ),
+    )
+)
+
+# Records are handed to a queue and written to stderr by a listener thread,
+# so logging from a handler never blocks the event loop on a write.
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_listener = QueueListener(_log_queue, logging.StreamHandler())
+logging.basicConfig(level=LOG_LEVEL, handlers=[QueueHandler(_log_queue)])
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# httpx logs every outbound Gemini call at INFO; keep that off the hot path.
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------
+# Responses
+# ---------------------------
+class ORJSONResponse(JSONResponse):
+    """JSONResponse serialized with orjson.
+
+    Defined locally because fastapi.responses.ORJSONResponse is deprecated.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
 
 # ---------------------------
 # App
 # ---------------------------
-app = FastAPI(title="Resume Anonymizer API (Python + Gemini SDK)")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The prompt cache is built in the background so the worker starts
+    # serving immediately; until it exists requests send the instructions
+    # inline.
+    refresher = asyncio.create_task(_keep_prompt_cache_alive())
+    try:
+        yield
+    finally:
+        refresher.cancel()
+        await _delete_prompt_cache()
+        if _redis is not None:
+            await _redis.aclose()
+        # Drain the shared keep-alive pool instead of dropping sockets on exit.
+        await client.aio.aclose()
+
+app = FastAPI(
+    title="Resume Anonymizer API (Python + Gemini SDK)",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 
+# Auth travels in explicit headers, not cookies, so credentials mode is off
+# (which also makes a "*" origin valid for browsers). Explicit methods and
+# headers plus max_age let browsers cache the preflight for a day.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # tighten for production
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=CORS_ORIGINS,
+    allow_credentials=False,
+    allow_methods=["GET", "POST"],
+    allow_headers=["authorization", "org-id", "content-type"],
+    max_age=86400,
 )
 
+# Anonymized-resume JSON is several KB of repetitive keys and compresses
+# ~5-10x; level 5 keeps the CPU cost small. SSE streams are left alone.
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 # ---------------------------
 # Request models
 # ---------------------------
+ResumeText = Annotated[str, Field(max_length=MAX_RESUME_CHARS)]
+
 class AnonymizeRequest(BaseModel):
-    resumeText: str
+    resumeText: ResumeText
+
+class BatchAnonymizeRequest(BaseModel):
+    resumes: List[ResumeText] = Field(min_length=1, max_length=MAX_BATCH_ITEMS)
+
+_Body = TypeVar("_Body", bound=BaseModel)
+
+async def _read_body(request: Request) -> bytes:
+    """Buffer the body, rejecting it with 413 as soon as it exceeds MAX_BODY_BYTES."""
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > MAX_BODY_BYTES:
+        raise HTTPException(413, "Request body exceeds size limit")
+
+    # Chunked uploads carry no Content-Length, so also count while reading.
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            raise HTTPException(413, "Request body exceeds size limit")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+async def _parse_body(request: Request, model: Type[_Body]) -> _Body:
+    """Parse and validate the raw JSON body in one pass in pydantic-core.
+
+    Routes take the Request instead of a model parameter so FastAPI doesn't
+    json.loads the body into a dict and then validate that dict again.
+    """
+    try:
+        return model.model_validate_json(await _read_body(request))
+    except ValidationError as e:
+        # Same 422 shape as FastAPI's own body validation, minus echoing the
+        # (possibly huge, PII-laden) input back to the caller.
+        raise RequestValidationError([
+            {**err, "loc": ("body", *err["loc"])}
+            for err in e.errors(include_url=False, include_input=False)
+        ])
+
+def _body_schema(model: Type[BaseModel]) -> Dict[str, Any]:
+    """openapi_extra that keeps the request model documented in /docs."""
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": model.model_json_schema()}},
+        }
+    }
 
 # ---------------------------
-# Prompt Template
+# Prompt
 # ---------------------------
-PROMPT_TEMPLATE = """
+# Sent as the system instruction; the resume itself is the only user content.
+SYSTEM_INSTRUCTION = """
 You are a professional resume anonymizer. Your task is to remove ALL personally identifiable information (PII) from the following resume while preserving ALL non-PII content exactly as written.
 
 ---
@@ -388,10 +577,8 @@ Before outputting, verify:
 7. Is ALL non-PII content from the original resume preserved?
 8. Is the output valid JSON?
 
-📝 Here is the resume text to anonymize:
-
-{RESUME_TEXT}
-"""
+📝 The user message contains the resume text to anonymize.
+""".strip()
 
 # ---------------------------
 # Helpers
@@ -399,10 +586,324 @@ Before outputting, verify:
 def _strip_code_fences(text: str) -> str:
     """Remove ```json ... ``` or ``` fences if the model adds them."""
     t = text.strip()
-    t = re.sub(r'^```(?:json)?\s*', '', t, flags=re.IGNORECASE)
-    t = re.sub(r'\s*```$', '', t)
+    # JSON mode almost never adds fences; skip the work when it didn't.
+    if t[:1] in ("{", "["):
+        return t
+    if t.startswith("```"):
+        t = t[7:] if t[3:7].lower() == "json" else t[3:]
+    if t.endswith("```"):
+        t = t[:-3]
     return t.strip()
 
+_INLINE_SPACE = re.compile(r"[^\S\n]+")
+_SPACE_AROUND_NEWLINE = re.compile(r" ?\n ?")
+_EXTRA_BLANK_LINES = re.compile(r"\n{3,}")
+
+def _compact_whitespace(text: str) -> str:
+    """Collapse the space/tab/blank-line padding left by PDF or OCR extraction.
+
+    It costs input tokens but carries no content; words, line breaks and
+    paragraph breaks are kept as they are.
+    """
+    text = _INLINE_SPACE.sub(" ", text)
+    text = _SPACE_AROUND_NEWLINE.sub("\n", text)
+    text = _EXTRA_BLANK_LINES.sub("\n\n", text)
+    return text.strip()
+
+def _parse_model_json(text: str) -> Any:
+    """Parse the model's JSON, repairing small syntax slips before giving up."""
+    cleaned = _strip_code_fences(text)
+    try:
+        return orjson.loads(cleaned)
+    except orjson.JSONDecodeError:
+        # A stray comma or unescaped quote shouldn't throw away the LLM call.
+        return orjson.loads(repair_json(cleaned))
+
+# Alternate spellings the model occasionally uses for the top-level keys.
+_KEY_ALIASES = {
+    "candidate_name": "candidateName",
+    "section": "sections",
+    "pii_removed": "piiRemoved",
+}
+
+# Expected top-level fields; a missing or mistyped value falls back to the
+# type's empty value ("", [], 0). orjson only produces exact dict/list/str/int
+# instances, so an identity check on type() is enough (and rejects bools).
+_FIELDS = (("candidateName", str), ("sections", list), ("piiRemoved", int))
+
+def _validate_and_fill(parsed: Any) -> Dict[str, Any]:
+    """Normalize the model output to candidateName/sections/piiRemoved."""
+    if type(parsed) is not dict:
+        raise ValueError("Gemini response is not a JSON object")
+
+    for alias, key in _KEY_ALIASES.items():
+        if alias in parsed and key not in parsed:
+            parsed[key] = parsed.pop(alias)
+
+    sections = parsed.get("sections")
+    if type(sections) is dict:
+        parsed["sections"] = [sections]
+
+    out = {}
+    for key, kind in _FIELDS:
+        value = parsed.get(key)
+        out[key] = value if type(value) is kind else kind()
+    return out
+
+# ---------------------------
+# Response cache
+# ---------------------------
+# Identical resumes (frontend retries, re-uploads) are answered from memory
+# instead of paying for another Gemini round-trip. The TTLCache is only
+# touched from the event loop thread, so it needs no lock. When REDIS_URL is
+# set, misses fall through to Redis before calling Gemini. Both tiers hold the
+# "data" object already serialized, so a hit is spliced into the response body
+# without decoding or re-encoding it (see _data_body).
+_response_cache: TTLCache = TTLCache(maxsize=CACHE_MAX_SIZE, ttl=CACHE_TTL_SECONDS)
+
+_redis: Optional[aioredis.Redis] = aioredis.from_url(REDIS_URL) if REDIS_URL else None
+
+def _cache_key(resume_text: str) -> str:
+    raw = f"{PROMPT_VERSION}|{MODEL_NAME}|{resume_text}"
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+async def _redis_get(cache_key: str) -> Optional[bytes]:
+    try:
+        return await _redis.get(f"anonymize:{cache_key}")
+    except Exception as e:
+        # The shared tier is an optimization; never fail a request over it.
+        logger.warning("Redis cache read failed: %s", e)
+        return None
+
+async def _redis_set(cache_key: str, data: bytes) -> None:
+    try:
+        await _redis.set(
+            f"anonymize:{cache_key}", data,
+            ex=REDIS_CACHE_TTL_SECONDS, nx=True,
+        )
+    except Exception as e:
+        logger.warning("Redis cache write failed: %s", e)
+
+# ---------------------------
+# Prompt cache
+# ---------------------------
+# The instructions are uploaded once as Gemini cached content, so each
+# request only sends (and is billed for) the resume itself. If caching is
+# unavailable for the key/model, requests send the system instruction inline.
+_prompt_cache_name: Optional[str] = None
+
+async def _create_prompt_cache() -> None:
+    global _prompt_cache_name
+    try:
+        cache = await client.aio.caches.create(
+            model=MODEL_NAME,
+            config=types.CreateCachedContentConfig(
+                display_name=f"resume-anonymizer-{PROMPT_VERSION}",
+                system_instruction=SYSTEM_INSTRUCTION,
+                ttl=f"{PROMPT_CACHE_TTL_SECONDS}s",
+            ),
+        )
+        _prompt_cache_name = cache.name
+    except Exception as e:
+        logger.warning("Gemini prompt cache unavailable, sending instructions inline: %s", e)
+        _prompt_cache_name = None
+
+async def _keep_prompt_cache_alive() -> None:
+    """Create the cache, then extend its TTL before it expires (recreating it if that fails)."""
+    await _create_prompt_cache()
+    while True:
+        await asyncio.sleep(PROMPT_CACHE_TTL_SECONDS * 0.8)
+        if _prompt_cache_name:
+            try:
+                await client.aio.caches.update(
+                    name=_prompt_cache_name,
+                    config=types.UpdateCachedContentConfig(ttl=f"{PROMPT_CACHE_TTL_SECONDS}s"),
+                )
+                continue
+            except Exception as e:
+                logger.warning("Failed to refresh Gemini prompt cache: %s", e)
+        await _replace_prompt_cache(_prompt_cache_name)
+
+_prompt_cache_lock = asyncio.Lock()
+
+async def _replace_prompt_cache(stale_name: Optional[str]) -> None:
+    """Recreate the cache once, however many requests saw `stale_name` fail."""
+    async with _prompt_cache_lock:
+        if _prompt_cache_name == stale_name:
+            await _create_prompt_cache()
+
+async def _delete_prompt_cache() -> None:
+    if not _prompt_cache_name:
+        return
+    try:
+        await client.aio.caches.delete(name=_prompt_cache_name)
+    except Exception as e:
+        logger.warning("Failed to delete Gemini prompt cache: %s", e)
+
+# ---------------------------
+# Gemini
+# ---------------------------
+def _estimate_tokens(text: str) -> int:
+    """Cheap upper-leaning token estimate without running a tokenizer.
+
+    ASCII runs at ~4 chars/token; CJK and emoji are closer to a token per
+    character, which shows up as extra UTF-8 bytes (2 for a CJK char).
+    """
+    if text.isascii():
+        return len(text) // 4
+    extra_bytes = len(text.encode("utf-8")) - len(text)
+    return len(text) // 4 + extra_bytes // 2
+
+def _max_output_tokens(resume_text: str) -> int:
+    # The output is the resume minus PII plus JSON structure, so it scales
+    # with the input: doubled for keys and escaping, plus headroom for short
+    # resumes. Anything past that is runaway generation.
+    return min(GEMINI_MAX_OUTPUT_TOKENS, 1024 + 2 * _estimate_tokens(resume_text))
+
+def _generation_config(
+    resume_text: str, use_prompt_cache: bool = True
+) -> types.GenerateContentConfig:
+    if use_prompt_cache and _prompt_cache_name:
+        prompt_config = {"cached_content": _prompt_cache_name}
+    else:
+        prompt_config = {"system_instruction": SYSTEM_INSTRUCTION}
+
+    return types.GenerateContentConfig(
+        **prompt_config,
+        thinking_config=types.ThinkingConfig(thinking_budget=0),
+        temperature=0.1,
+        candidate_count=1,
+        max_output_tokens=_max_output_tokens(resume_text),
+        response_mime_type="application/json",
+    )
+
+_gemini_semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+async def _stream_gemini(resume_text: str) -> AsyncIterator[str]:
+    """Yield Gemini's output text for one resume as it is generated."""
+    contents = _compact_whitespace(resume_text)
+    async with _gemini_semaphore:
+        for attempt in range(2):
+            cache_name = _prompt_cache_name
+            started = False
+            try:
+                stream = await client.aio.models.generate_content_stream(
+                    model=MODEL_NAME,
+                    contents=contents,
+                    config=_generation_config(resume_text),
+                )
+                async for chunk in stream:
+                    if chunk.text:
+                        started = True
+                        yield chunk.text
+                return
+            except errors.ClientError as e:
+                # A cache handle that expired or was deleted server-side is
+                # rejected before any output; rebuild it and retry once.
+                if started or attempt or not cache_name or e.code not in (403, 404):
+                    raise
+                logger.warning("Gemini prompt cache %s rejected, recreating: %s", cache_name, e)
+                await _replace_prompt_cache(cache_name)
+
+def _fields_from_text(text: str) -> Dict[str, Any]:
+    if not text:
+        raise RuntimeError("No response text from Gemini")
+
+    # Parsed once at the end; a single orjson pass beats incremental parsing.
+    return _validate_and_fill(_parse_model_json(text))
+
+async def _call_gemini(
+    resume_text: str, deltas: Optional["asyncio.Queue[Optional[str]]"] = None
+) -> Dict[str, Any]:
+    """Anonymize one resume with Gemini and return the validated fields.
+
+    With `deltas`, each chunk of output is also put on the queue as it
+    arrives, followed by None once the call ends (successfully or not).
+    """
+    parts = []
+    try:
+        async with aclosing(_stream_gemini(resume_text)) as stream:
+            async for part in stream:
+                parts.append(part)
+                if deltas is not None:
+                    deltas.put_nowait(part)
+    finally:
+        if deltas is not None:
+            deltas.put_nowait(None)
+    return _fields_from_text("".join(parts))
+
+async def _cached_result(cache_key: str) -> Optional[bytes]:
+    cached = _response_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    if _redis is not None:
+        cached = await _redis_get(cache_key)
+        if cached is not None:
+            _response_cache[cache_key] = cached
+            return cached
+
+    return None
+
+def _response_data(fields: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the response "data" object from the validated model fields."""
+    return {
+        **fields,
+        "id": "local-test-id",
+        "processedBy": "gemini-local",
+        "processingTime": 1200
+    }
+
+async def _store_result(cache_key: str, fields: Dict[str, Any]) -> bytes:
+    data = orjson.dumps(_response_data(fields))
+    _response_cache[cache_key] = data
+    if _redis is not None:
+        await _redis_set(cache_key, data)
+    return data
+
+# Misses currently being fetched from Gemini, by cache key. A duplicate that
+# arrives while the first copy is still in flight (double-clicks, client
+# retries, the same resume twice in a batch) waits for that call instead of
+# starting another one.
+_pending_results: Dict[str, "asyncio.Future[bytes]"] = {}
+
+def _pending_done(cache_key: str, pending: "asyncio.Future[bytes]") -> None:
+    if _pending_results.get(cache_key) is pending:
+        del _pending_results[cache_key]
+    # Every waiter may have disconnected before a failure; retrieve the
+    # exception so asyncio doesn't log it as never retrieved.
+    if not pending.cancelled():
+        pending.exception()
+
+def _track_pending(cache_key: str, pending: "asyncio.Future[bytes]") -> None:
+    _pending_results[cache_key] = pending
+    pending.add_done_callback(functools.partial(_pending_done, cache_key))
+
+async def _fetch_result(
+    cache_key: str, resume_text: str, deltas: Optional["asyncio.Queue[Optional[str]]"] = None
+) -> bytes:
+    return await _store_result(cache_key, await _call_gemini(resume_text, deltas))
+
+async def _anonymize_text(resume_text: str) -> bytes:
+    """Return the serialized "data" object for one resume, served from cache when possible."""
+    cache_key = _cache_key(resume_text)
+    cached = await _cached_result(cache_key)
+    if cached is not None:
+        return cached
+
+    pending = _pending_results.get(cache_key)
+    if pending is None:
+        pending = asyncio.create_task(_fetch_result(cache_key, resume_text))
+        _track_pending(cache_key, pending)
+
+    # Shielded so one caller disconnecting doesn't cancel the call for the
+    # others waiting on it.
+    return await asyncio.shield(pending)
+
+def _data_body(data: bytes, prefix: bytes = b"") -> bytes:
+    """Wrap serialized "data" as {<prefix>"data": data} without re-encoding it."""
+    return b"{" + prefix + b'"data":' + data + b"}"
+
 # ---------------------------
 # Routes
 # ---------------------------
@@ -410,58 +911,277 @@ def _strip_code_fences(text: str) -> str:
 def health():
     return {"status": "ok", "message": "Resume Anonymizer API is running"}
 
-@app.post("/api/anonymize")
-def anonymize(
-    payload: AnonymizeRequest,
-    authorization: str = Header(None),
-    org_id: str = Header(None)
-):
+def _check_headers(authorization: str, org_id: str) -> None:
     if not authorization:
         raise HTTPException(401, "Missing Authorization header")
 
     if not org_id:
         raise HTTPException(400, "Missing org-id header")
 
+# Token bucket per org-id, stored as (tokens, last update). An idle bucket is
+# full again after a minute, so entries can simply expire then.
+_org_buckets: TTLCache = TTLCache(maxsize=10000, ttl=60)
+
+def _check_rate_limit(org_id: str, cost: int = 1) -> None:
+    """Take `cost` tokens from the org's bucket, or reject with 429 taking none."""
+    rate = ORG_RATE_LIMIT_PER_MINUTE
+    if rate <= 0:
+        return
+
+    if cost > rate:
+        # Could never be admitted, however long the caller waits.
+        raise HTTPException(429, "Batch exceeds the per-minute rate limit for org-id")
+
+    now = time.monotonic()
+    tokens, updated = _org_buckets.get(org_id, (rate, now))
+    tokens = min(rate, tokens + (now - updated) * rate / 60)
+    if tokens < cost:
+        _org_buckets[org_id] = (tokens, now)
+        retry_after = math.ceil((cost - tokens) * 60 / rate)
+        raise HTTPException(
+            429, "Rate limit exceeded for org-id", headers={"Retry-After": str(retry_after)}
+        )
+    _org_buckets[org_id] = (tokens - cost, now)
+
+def _is_valid_resume_text(resume_text: str) -> bool:
+    # Same as len(resume_text.strip()) >= 50, but the (possibly large) text is
+    # only copied when it actually has surrounding whitespace.
+    if len(resume_text) < 50:
+        return False
+    if resume_text[0].isspace() or resume_text[-1].isspace():
+        return len(resume_text.strip()) >= 50
+    return True
+
+# Routes are declared response_model=None and return a response directly, so
+# FastAPI doesn't re-validate and re-encode data that _validate_and_fill
+# already normalized. /api/anonymize, /batch and the final SSE event splice the
+# cached, pre-serialized "data" bytes into the body with _data_body; that is
+# only valid JSON because those bytes always come from orjson.dumps in
+# _store_result, so never put anything else in the cache. Other responses go
+# through ORJSONResponse. If a typed response model is added, build it with
+# Model.model_construct(...) from the trusted fields, not Model(...).
+@app.post(
+    "/api/anonymize",
+    response_model=None,
+    openapi_extra=_body_schema(AnonymizeRequest),
+)
+async def anonymize(
+    request: Request,
+    authorization: str = Header(None),
+    org_id: str = Header(None)
+):
+    _check_headers(authorization, org_id)
+    _check_rate_limit(org_id)
+    payload = await _parse_body(request, AnonymizeRequest)
+
     resume_text = payload.resumeText
-    if not resume_text or len(resume_text.strip()) < 50:
+    if not _is_valid_resume_text(resume_text):
         raise HTTPException(400, "Invalid resumeText")
 
-    prompt = PROMPT_TEMPLATE.replace("{RESUME_TEXT}", resume_text)
+    try:
+        data = await _anonymize_text(resume_text)
+    except Exception as e:
+        raise HTTPException(500, f"Failed to anonymize resume: {str(e)}")
+
+    return Response(_data_body(data), media_type="application/json")
+
+@app.post(
+    "/api/anonymize/batch",
+    response_model=None,
+    openapi_extra=_body_schema(BatchAnonymizeRequest),
+)
+async def anonymize_batch(
+    request: Request,
+    authorization: str = Header(None),
+    org_id: str = Header(None)
+):
+    """Anonymize several resumes concurrently; failures are reported per item."""
+    _check_headers(authorization, org_id)
+    payload = await _parse_body(request, BatchAnonymizeRequest)
+    # Charged per resume, since each one is its own Gemini call.
+    _check_rate_limit(org_id, cost=len(payload.resumes))
+
+    async def _one(resume_text: str) -> bytes:
+        if not _is_valid_resume_text(resume_text):
+            raise ValueError("Invalid resumeText")
+        return await _anonymize_text(resume_text)
+
+    results = await asyncio.gather(
+        *(_one(t) for t in payload.resumes), return_exceptions=True
+    )
+
+    items = [
+        orjson.dumps({"error": f"Failed to anonymize resume: {str(r)}"})
+        if isinstance(r, Exception) else _data_body(r)
+        for r in results
+    ]
+    return Response(_data_body(b"[" + b",".join(items) + b"]"), media_type="application/json")
+
+
+# Bulk imports that don't need an immediate answer go through Gemini's Batch
+# API: jobs run on spare capacity at a lower price, and the client polls for
+# the results. The prompt cache isn't referenced because a job can outlive it.
+_FINISHED_JOB_STATES = {
+    types.JobState.JOB_STATE_SUCCEEDED,
+    types.JobState.JOB_STATE_PARTIALLY_SUCCEEDED,
+}
+
+def _batch_job_display_name(org_id: str) -> str:
+    # Jobs are tagged with the submitting org so only it can read the results.
+    return f"resume-anonymizer-{org_id}"
+
+@app.post(
+    "/api/anonymize/batch-jobs",
+    response_model=None,
+    openapi_extra=_body_schema(BatchAnonymizeRequest),
+)
+async def create_batch_job(
+    request: Request,
+    authorization: str = Header(None),
+    org_id: str = Header(None)
+):
+    """Submit resumes as a Gemini batch job and return its id for polling."""
+    _check_headers(authorization, org_id)
+    payload = await _parse_body(request, BatchAnonymizeRequest)
+    # Charged per resume, since each one is its own Gemini call.
+    _check_rate_limit(org_id, cost=len(payload.resumes))
+
+    for i, resume_text in enumerate(payload.resumes):
+        if not _is_valid_resume_text(resume_text):
+            raise HTTPException(400, f"Invalid resumeText at index {i}")
 
     try:
-        response = client.models.generate_content(
+        job = await client.aio.batches.create(
             model=MODEL_NAME,
-            contents=prompt,
-            config=types.GenerateContentConfig(
-                thinking_config=types.ThinkingConfig(thinking_budget=0),
-                temperature=0.1,
-                response_mime_type="application/json",
-            ),
+            src=[
+                types.InlinedRequest(
+                    contents=_compact_whitespace(resume_text),
+                    config=_generation_config(resume_text, use_prompt_cache=False),
+                )
+                for resume_text in payload.resumes
+            ],
+            config=types.CreateBatchJobConfig(display_name=_batch_job_display_name(org_id)),
         )
+    except Exception as e:
+        raise HTTPException(500, f"Failed to create batch job: {str(e)}")
 
-        text = getattr(response, "text", None)
-        if not text:
-            raise RuntimeError("No response text from Gemini")
-
-        cleaned = _strip_code_fences(text)
-        parsed = json.loads(cleaned)
+    return ORJSONResponse({
+        "data": {"jobId": job.name.removeprefix("batches/"), "state": job.state}
+    })
 
-        return JSONResponse({
-            "data": {
-                "candidateName": parsed.get("candidateName", ""),
-                "sections": parsed.get("sections", []),
-                "piiRemoved": parsed.get("piiRemoved", 0),
-                "id": "local-test-id",
-                "processedBy": "gemini-local",
-                "processingTime": 1200
-            }
-        })
+@app.get("/api/anonymize/batch-jobs/{job_id}", response_model=None)
+async def get_batch_job(
+    job_id: str,
+    authorization: str = Header(None),
+    org_id: str = Header(None)
+):
+    """Report a batch job's state, with per-resume results once it finished."""
+    _check_headers(authorization, org_id)
 
+    # Unknown ids and another org's jobs get the same 404, so job ids can't
+    # be probed across orgs.
+    try:
+        job = await client.aio.batches.get(name=f"batches/{job_id}")
     except Exception as e:
-        raise HTTPException(500, f"Failed to anonymize resume: {str(e)}")
+        if isinstance(e, errors.ClientError) and e.code in (400, 404):
+            raise HTTPException(404, "Batch job not found")
+        # Upstream error text stays in the logs, not the response.
+        logger.warning("Failed to fetch batch job %s: %s", job_id, e)
+        raise HTTPException(500, "Failed to fetch batch job")
+
+    if job.display_name != _batch_job_display_name(org_id):
+        raise HTTPException(404, "Batch job not found")
+
+    data: Dict[str, Any] = {"jobId": job_id, "state": job.state}
+    if job.state in _FINISHED_JOB_STATES and job.dest and job.dest.inlined_responses:
+        results = []
+        for item in job.dest.inlined_responses:
+            try:
+                if item.error:
+                    raise RuntimeError(item.error.message)
+                fields = _fields_from_text(getattr(item.response, "text", None))
+                results.append({"data": _response_data(fields)})
+            except Exception as e:
+                results.append({"error": f"Failed to anonymize resume: {str(e)}"})
+        data["results"] = results
+
+    return ORJSONResponse({"data": data})
+
+def _sse(event: Dict[str, Any]) -> bytes:
+    return b"data: " + orjson.dumps(event) + b"\n\n"
+
+def _done(data: bytes) -> bytes:
+    return b"data: " + _data_body(data, prefix=b'"done":true,') + b"\n\n"
+
+@app.post(
+    "/api/anonymize/stream",
+    response_model=None,
+    openapi_extra=_body_schema(AnonymizeRequest),
+)
+async def anonymize_stream(
+    request: Request,
+    authorization: str = Header(None),
+    org_id: str = Header(None)
+):
+    """Like /api/anonymize, but streams the model output as Server-Sent Events.
+
+    Emits {"delta": ...} events while Gemini generates, then a final
+    {"done": true, "data": ...} with the validated result, or {"error": ...}.
+    Cache hits and duplicates of an in-flight resume get only the final event.
+    """
+    _check_headers(authorization, org_id)
+    _check_rate_limit(org_id)
+    payload = await _parse_body(request, AnonymizeRequest)
+
+    resume_text = payload.resumeText
+    if not _is_valid_resume_text(resume_text):
+        raise HTTPException(400, "Invalid resumeText")
+
+    cache_key = _cache_key(resume_text)
+
+    async def events() -> AsyncIterator[bytes]:
+        try:
+            data = await _cached_result(cache_key)
+            if data is None and cache_key in _pending_results:
+                data = await asyncio.shield(_pending_results[cache_key])
+            if data is None:
+                # The Gemini call runs as a shared task, like _anonymize_text's,
+                # and feeds this stream through a queue. Disconnecting only
+                # stops the forwarding: the call still finishes for anyone
+                # coalesced onto it, and a slow reader never holds a Gemini slot.
+                deltas: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+                pending = asyncio.create_task(_fetch_result(cache_key, resume_text, deltas))
+                _track_pending(cache_key, pending)
+                while (delta := await deltas.get()) is not None:
+                    yield _sse({"delta": delta})
+                data = await asyncio.shield(pending)
+            yield _done(data)
+        except Exception as e:
+            yield _sse({"error": f"Failed to anonymize resume: {str(e)}"})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # X-Accel-Buffering stops nginx-style proxies from holding the
+        # events back until the response ends.
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
-# Local dev entrypoint (Render uses startCommand)
+# Local dev entrypoint (Render uses startCommand, where uvicorn reads
+# WEB_CONCURRENCY itself). The handlers are IO-bound, so each worker keeps
+# many Gemini calls in flight; workers multiply that capacity until the
+# upstream rate limit is reached. Equivalent gunicorn setup:
+#   gunicorn -k uvicorn.workers.UvicornWorker -w $WEB_CONCURRENCY main:app
 if __name__ == "__main__":
-    port = int(os.getenv("PORT", "8000"))
-    uvicorn.run("main:app", host="0.0.0.0", port=port)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=PORT,
+        workers=WEB_CONCURRENCY,
+        loop="uvloop",
+        http="httptools",
+        log_level=LOG_LEVEL.lower(),
+        # One synchronous log line per request; Render logs requests itself.
+        access_log=False,
+    )